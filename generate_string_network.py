@@ -10,12 +10,39 @@ Usage:
 """
 
 import argparse
+import hashlib
+import logging
+import os
+from itertools import chain
+import numpy as np
 import pandas as pd
 import requests
-import io
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sys
+import tempfile
 import time
 
+logger = logging.getLogger('perturbviz')
+
+# Shared HTTP session so repeated STRING calls reuse keep-alive connections
+# and retry transient server errors
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset(['GET', 'POST']))
+))
+
+# Cached STRING networks older than this (in seconds) are fetched again
+CACHE_TTL = 7 * 24 * 3600
+
+# Bump whenever the post-processing of fetched networks changes so that
+# entries written in an older format are no longer served
+CACHE_VERSION = 2
+
 def parse_arguments():
     """Parse command-line arguments."""
     parser = argparse.ArgumentParser(description='Generate network file from STRING database')
@@ -29,62 +56,83 @@ def parse_arguments():
     parser.add_argument('--score', type=int, default=400,
                       help='Minimum interaction confidence score (0-1000, default: 400)')
     parser.add_argument('--output', '-o', default='string_network.tsv',
-                      help='Output network file name')
+                      help='Output network file name (.tsv, .tsv.gz or .parquet)')
     parser.add_argument('--additional', '-a', type=int, default=50,
                       help='Number of additional interactors to include (default: 50)')
+    parser.add_argument('--cache-dir', default='.string_cache',
+                      help='Directory for cached STRING networks (default: .string_cache)')
+    parser.add_argument('--no-cache', action='store_true',
+                      help='Always query STRING instead of using cached networks')
+    parser.add_argument('--quiet', '-q', action='store_true',
+                      help='Only report warnings and errors')
     
     return parser.parse_args()
 
 def load_gene_list(gene_input):
     """Load genes from file or parse comma-separated list."""
-    if ',' in gene_input:
-        # Parse comma-separated list
-        genes = [g.strip() for g in gene_input.split(',')]
-        print(f"Parsed {len(genes)} genes from input string")
-        return genes
+    if os.path.isfile(gene_input):
+        try:
+            # Read from file (one gene per line); split() also drops blank lines
+            with open(gene_input, 'r') as f:
+                genes = f.read().split()
+            logger.info("Loaded %d genes from file %s", len(genes), gene_input)
+            return genes
+        except Exception as e:
+            logger.error("Error reading gene file: %s", e)
+            sys.exit(1)
     
-    try:
-        # Read from file (one gene per line)
-        with open(gene_input, 'r') as f:
-            genes = [line.strip() for line in f if line.strip()]
-        print(f"Loaded {len(genes)} genes from file {gene_input}")
-        return genes
-    except Exception as e:
-        print(f"Error reading gene file: {e}")
+    # A single entry that looks like a path is most likely a mistyped file name
+    # (an alphabetic extension such as .txt/.tsv; symbols like AC010.1 are genes)
+    extension = os.path.splitext(gene_input)[1][1:]
+    if ',' not in gene_input and (os.sep in gene_input or extension.isalpha()):
+        logger.error("Error reading gene file: %s does not exist", gene_input)
         sys.exit(1)
+    
+    # Parse comma-separated list
+    genes = [g for g in map(str.strip, gene_input.split(',')) if g]
+    logger.info("Parsed %d genes from input string", len(genes))
+    return genes
 
 def load_deg_genes(deg_file, top_n=10):
     """Load top differentially expressed genes from DEG file."""
     try:
-        df = pd.read_csv(deg_file, sep='\t')
+        # Read the header first so only the two needed columns are parsed
+        columns = pd.read_csv(deg_file, sep='\t', nrows=0).columns
         
         # Ensure proper column names
-        if 'gene' not in df.columns or 'log2FC' not in df.columns:
-            if len(df.columns) >= 2:
-                df.columns = ['gene', 'log2FC'] + list(df.columns[2:])
-                print("Warning: Renamed columns to 'gene' and 'log2FC'")
-            else:
-                print("Error: DEG file must have at least two columns")
-                return [], []
+        if 'gene' in columns and 'log2FC' in columns:
+            df = pd.read_csv(deg_file, sep='\t', usecols=['gene', 'log2FC'])
+        elif len(columns) >= 2:
+            df = pd.read_csv(deg_file, sep='\t', usecols=[0, 1])
+            df.columns = ['gene', 'log2FC']
+            logger.warning("Warning: Renamed columns to 'gene' and 'log2FC'")
+        else:
+            logger.error("Error: DEG file must have at least two columns")
+            return [], []
         
-        # Sort by absolute log2FC
-        df['abs_log2FC'] = df['log2FC'].abs()
-        sorted_df = df.sort_values('abs_log2FC', ascending=False)
+        # Get top upregulated genes (largest positive log2FC)
+        top_up = df.nlargest(top_n, 'log2FC')
+        up_genes = top_up.loc[top_up['log2FC'] > 0, 'gene'].tolist()
         
-        # Get top upregulated genes
-        up_genes = sorted_df[sorted_df['log2FC'] > 0].head(top_n)['gene'].tolist()
+        # Get top downregulated genes (most negative log2FC)
+        top_down = df.nsmallest(top_n, 'log2FC')
+        down_genes = top_down.loc[top_down['log2FC'] < 0, 'gene'].tolist()
         
-        # Get top downregulated genes
-        down_genes = sorted_df[sorted_df['log2FC'] < 0].head(top_n)['gene'].tolist()
-        
-        print(f"Selected top {len(up_genes)} upregulated and {len(down_genes)} downregulated genes")
+        logger.info("Selected top %d upregulated and %d downregulated genes", len(up_genes), len(down_genes))
         return up_genes, down_genes
     
     except Exception as e:
-        print(f"Error loading DEG file: {e}")
+        logger.error("Error loading DEG file: %s", e)
         return [], []
 
-def get_string_network(gene_list, species='9606', score_threshold=400, additional_interactors=50):
+def get_cache_path(cache_dir, gene_list, species, score_threshold, additional_interactors):
+    """Return the cache file path for a STRING query, keyed on its parameters."""
+    query = f"v{CACHE_VERSION}|{species}|{score_threshold}|{additional_interactors}|{','.join(sorted(gene_list))}"
+    key = hashlib.blake2b(query.encode(), digest_size=16).hexdigest()
+    return os.path.join(cache_dir, f"{key}.tsv")
+
+def get_string_network(gene_list, species='9606', score_threshold=400, additional_interactors=50,
+                       cache_dir=None):
     """
     Retrieve protein-protein interactions from STRING database.
     
@@ -93,12 +141,28 @@ def get_string_network(gene_list, species='9606', score_threshold=400, additiona
         species: NCBI taxonomy ID (9606 for human)
         score_threshold: Minimum interaction score (0-1000)
         additional_interactors: Number of additional interacting proteins to include
+        cache_dir: Directory for cached networks (None to disable caching)
         
     Returns:
         DataFrame with source and target columns
     """
-    print(f"\nQuerying STRING database for {len(gene_list)} genes...")
-    print(f"Using confidence score threshold: {score_threshold}")
+    logger.info("\nQuerying STRING database for %d genes...\nUsing confidence score threshold: %s",
+                len(gene_list), score_threshold)
+    
+    # Reuse a recent network fetched with the same parameters
+    cache_file = None
+    if cache_dir:
+        cache_file = get_cache_path(cache_dir, gene_list, species, score_threshold, additional_interactors)
+        if os.path.isfile(cache_file) and time.time() - os.path.getmtime(cache_file) < CACHE_TTL:
+            try:
+                cached_network = pd.read_csv(cache_file, sep='\t', dtype='category',
+                                             keep_default_na=False)
+                if list(cached_network.columns) != ['source', 'target'] or cached_network.empty:
+                    raise ValueError("unexpected or empty network")
+                logger.info("Using cached STRING network from %s", cache_file)
+                return cached_network
+            except Exception as e:
+                logger.warning("Warning: ignoring unreadable cache file %s: %s", cache_file, e)
     
     string_api_url = "https://string-db.org/api"
     output_format = "tsv"
@@ -106,7 +170,7 @@ def get_string_network(gene_list, species='9606', score_threshold=400, additiona
     
     # Set parameters
     params = {
-        "identifiers": "%0d".join(gene_list),  # Your proteins
+        "identifiers": "\r".join(gene_list),  # Your proteins (CR-separated)
         "species": species,                    # Species NCBI identifier
         "caller_identity": "PerturbViz",       # Your app name
         "add_nodes": additional_interactors,   # Additional interactors
@@ -116,42 +180,74 @@ def get_string_network(gene_list, species='9606', score_threshold=400, additiona
     
     # Call STRING API
     try:
-        print("Sending request to STRING database...")
-        response = requests.post(f"{string_api_url}/{output_format}/{method}", data=params)
-        
-        # Check if the request was successful
-        if response.status_code != 200:
-            print(f"Error: HTTP Status Code {response.status_code}")
-            print(f"Response: {response.text}")
-            return None
-        
-        # Read the result into a DataFrame
-        network_data = pd.read_csv(io.StringIO(response.text), sep='\t')
+        logger.info("Sending request to STRING database...")
+        with _SESSION.post(f"{string_api_url}/{output_format}/{method}", data=params,
+                           stream=True, timeout=(5, 120)) as response:
+            
+            # Check if the request was successful
+            if response.status_code != 200:
+                logger.error("Error: HTTP Status Code %d\nResponse: %s", response.status_code, response.text)
+                return None
+            
+            # Stream the result into a DataFrame, keeping only the gene name columns;
+            # names such as "NA" stay strings so the pair sort below never sees NaN
+            response.raw.decode_content = True
+            network_data = pd.read_csv(response.raw, sep='\t',
+                                       usecols=['preferredName_A', 'preferredName_B'],
+                                       dtype=str, keep_default_na=False)
         
         if network_data.empty:
-            print("No interactions found for the provided genes.")
+            logger.warning("No interactions found for the provided genes.")
             return None
             
-        # Print information about the network
-        print(f"Retrieved network with {len(network_data)} interactions")
-        print(f"Network contains {len(set(network_data['preferredName_A'].tolist() + network_data['preferredName_B'].tolist()))} unique genes")
+        # Report network statistics; the unique-gene count is only computed when shown
+        if logger.isEnabledFor(logging.INFO):
+            n_unique = pd.unique(network_data.to_numpy().ravel('K')).size
+            logger.info("Retrieved network with %d interactions\nNetwork contains %d unique genes",
+                        len(network_data), n_unique)
+        
+        # Create simplified network format: order each pair so A-B and B-A
+        # collapse, and drop self-loops on the array before building the frame
+        edges = np.sort(network_data.to_numpy(), axis=1)
+        edges = edges[edges[:, 0] != edges[:, 1]]
+        simplified_network = pd.DataFrame(edges, columns=['source', 'target']).drop_duplicates(ignore_index=True)
+        if len(simplified_network) < len(network_data):
+            logger.info("Removed %d duplicate or self-loop edges", len(network_data) - len(simplified_network))
         
-        # Create simplified network format
-        simplified_network = network_data[['preferredName_A', 'preferredName_B']].copy()
-        simplified_network.columns = ['source', 'target']
+        # Gene names repeat across many edges, so store them as categories
+        simplified_network = simplified_network.astype('category')
+        
+        # Save to cache for subsequent runs; write to a temporary file and move it
+        # into place so readers never see a partially written network
+        if cache_file:
+            tmp_file = None
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp',
+                                                 delete=False) as tmp:
+                    tmp_file = tmp.name
+                    simplified_network.to_csv(tmp, sep='\t', index=False)
+                os.replace(tmp_file, cache_file)
+            except OSError as e:
+                logger.warning("Warning: could not write cache file %s: %s", cache_file, e)
+                if tmp_file and os.path.exists(tmp_file):
+                    os.remove(tmp_file)
         
         return simplified_network
         
     except requests.exceptions.RequestException as e:
-        print(f"Error connecting to STRING database: {e}")
+        logger.error("Error connecting to STRING database: %s", e)
         return None
     except Exception as e:
-        print(f"Unexpected error: {e}")
+        logger.error("Unexpected error: %s", e)
         return None
 
 def main():
     """Main function to run the script."""
     args = parse_arguments()
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format='%(message)s')
+    
+    logger.info("STRING Network Generator for PerturbViz\n======================================")
     
     # Load perturbed genes
     perturbed_genes = load_gene_list(args.genes)
@@ -161,34 +257,39 @@ def main():
     if args.degs:
         up_genes, down_genes = load_deg_genes(args.degs)
     
-    # Combine all gene lists, remove duplicates
-    all_genes = list(set(perturbed_genes + up_genes + down_genes))
+    # Combine all gene lists, remove duplicates while keeping input order
+    all_genes = list(dict.fromkeys(chain(perturbed_genes, up_genes, down_genes)))
     
-    print(f"Total input genes: {len(all_genes)}")
-    print(f"  - Perturbed genes: {len(perturbed_genes)}")
-    print(f"  - Upregulated genes: {len(up_genes)}")
-    print(f"  - Downregulated genes: {len(down_genes)}")
+    logger.info("Total input genes: %d\n  - Perturbed genes: %d\n  - Upregulated genes: %d\n  - Downregulated genes: %d",
+                len(all_genes), len(perturbed_genes), len(up_genes), len(down_genes))
     
     # Get network from STRING
-    network_df = get_string_network(all_genes, args.species, args.score, args.additional)
+    cache_dir = None if args.no_cache else args.cache_dir
+    network_df = get_string_network(all_genes, args.species, args.score, args.additional, cache_dir)
     
     if network_df is None or len(network_df) == 0:
-        print("\nFailed to retrieve network or no interactions found.")
+        logger.error("\nFailed to retrieve network or no interactions found.")
         sys.exit(1)
     
     # Save network file
     try:
-        network_df.to_csv(args.output, sep='\t', index=False)
-        print(f"\nSuccessfully saved network file to {args.output}")
-        print(f"Network has {len(network_df)} edges")
+        # Pick the format from the extension; to_csv compresses .gz/.bz2/.zst outputs
+        if args.output.endswith('.parquet'):
+            network_df.to_parquet(args.output, index=False, compression='zstd')
+        else:
+            network_df.to_csv(args.output, sep='\t', index=False)
+        logger.info("\nSuccessfully saved network file to %s\nNetwork has %d edges", args.output, len(network_df))
     except Exception as e:
-        print(f"Error saving network file: {e}")
+        logger.error("Error saving network file: %s", e)
         sys.exit(1)
     
-    print("\nNetwork generation complete! You can now use this file with PerturbViz.")
-    print(f"Example: python perturbviz.py --network {args.output} --perturbed {args.genes} --degs {args.degs or 'your_degs_file.tsv'}")
+    if args.output.endswith('.parquet'):
+        logger.info("\nNetwork generation complete! Note: PerturbViz reads TSV networks, "
+                    "so write a .tsv output to use this network with it.")
+    else:
+        logger.info("\nNetwork generation complete! You can now use this file with PerturbViz.\n"
+                    "Example: python perturbviz.py --network %s --perturbed %s --degs %s",
+                    args.output, args.genes, args.degs or 'your_degs_file.tsv')
 
 if __name__ == "__main__":
-    print("STRING Network Generator for PerturbViz")
-    print("======================================")
     main()